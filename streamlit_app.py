@@ -1,10 +1,13 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import math
+import os
 import pickle
-import requests
-import altair as alt
-import difflib
+import tempfile
+from functools import lru_cache
+import requests_cache
+from rapidfuzz import fuzz, process
 
 # --- Page config ---
 st.set_page_config(
@@ -17,91 +20,239 @@ st.set_page_config(
 if "made_estimate" not in st.session_state:
     st.session_state["made_estimate"] = False
 
+DATA_XLSX = "226842_196b62e8465_127512.xlsx"
+# bump when _ensure_parquet's output changes (columns, dtypes): the version is
+# part of the file name, so an upgraded deployment rebuilds instead of reusing
+# a parquet written by the old conversion
+_PARQUET_SCHEMA = 3
+DATA_PARQUET = f"226842_196b62e8465_127512.v{_PARQUET_SCHEMA}.parquet"
+
+# dates used across the run, computed once instead of per widget/filter
+_TODAY = pd.Timestamp.now().normalize()
+_CUTOFF_120 = _TODAY - pd.Timedelta(days=120)
+
+# workbook columns the app reads; the rest (e.g. VIN8) never reach the parquet copy
+_DATA_COLUMNS = [
+    "Sold Date","Year","Make","Model","Series","Engine Code","Grade","Mileage",
+    "Drivable","Auction Region","Color","Roof","Interior","Sale Price"
+]
+
 # --- Caching data & model ---
-@st.cache_data(show_spinner=False)
-def load_data():
+def _ensure_parquet():
+    # parse the workbook once; later cold starts read the typed parquet copy
+    if (os.path.exists(DATA_PARQUET)
+            and os.path.getmtime(DATA_PARQUET) >= os.path.getmtime(DATA_XLSX)):
+        return
     df = pd.read_excel(
-        "226842_196b62e8465_127512.xlsx",
-        parse_dates=["Sold Date"], engine="openpyxl"
+        DATA_XLSX, usecols=_DATA_COLUMNS,
+        parse_dates=["Sold Date"], engine="calamine"
     )
     df["sale_month"] = df["Sold Date"].dt.month
-    df["age"] = pd.Timestamp.now().year - df["Year"]
+    # narrow numerics: more rows per cache line for the year/price scans
+    df = df.astype({
+        "Year":"int16","Mileage":"int32","Grade":"float32",
+        "Sale Price":"int32","sale_month":"int8"
+    })
     # ensure no nulls sneak into our categorical columns
     for c in ["Make","Model","Series","Engine Code","Roof","Interior"]:
         df[c] = df[c].fillna("").astype(str)
-    return df
+    # low-cardinality labels: compare/group on int codes, not python strings
+    for c in ["Make","Model","Series","Engine Code","Roof","Interior","Auction Region","Color"]:
+        df[c] = df[c].astype("category")
+    # write beside the target and rename into place: a run killed mid-write
+    # leaves a stray temp file, never a truncated parquet newer than the xlsx
+    fd, tmp = tempfile.mkstemp(suffix=".parquet.tmp", dir=os.path.dirname(os.path.abspath(DATA_PARQUET)))
+    os.close(fd)
+    try:
+        df.to_parquet(tmp, compression="zstd")
+        os.replace(tmp, DATA_PARQUET)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+# data_version (the workbook's mtime) is the cache key, so a refreshed xlsx
+# invalidates these without streamlit hashing the whole frame
+@st.cache_data(show_spinner=False)
+def load_data(data_version):
+    _ensure_parquet()
+    df = pd.read_parquet(DATA_PARQUET)
+    df["age"] = (_TODAY.year - df["Year"]).astype("int8")
+    # sorted (Make, Model, Series) index: history lookups become a binary search;
+    # Sold Date as the secondary key keeps each trim's rows in date order
+    df = df.sort_values(["Make","Model","Series","Sold Date"])
+    return df.set_index(["Make","Model","Series"])
 
 @st.cache_resource(show_spinner=False)
 def load_model():
     with open("model_pipeline.pkl","rb") as f:
         return pickle.load(f)
 
+def _options_by(keys, col):
+    # {key: sorted tuple of distinct col labels}, worked out on category codes with
+    # one np.unique over the (key codes, col code) rows. Categories are stored
+    # in sorted order, so ordering codes orders labels
+    codes = np.column_stack([k.cat.codes.to_numpy() for k in keys] + [col.cat.codes.to_numpy()])
+    pairs = np.unique(codes,axis=0)
+    k, c = pairs[:,:-1], pairs[:,-1]
+    starts = np.flatnonzero(np.r_[True,(k[1:]!=k[:-1]).any(axis=1)])
+    labels = np.split(np.asarray(col.cat.categories)[c],starts[1:])
+    cats = [np.asarray(x.cat.categories) for x in keys]
+    names = [tuple(cat[i] for cat,i in zip(cats,row)) for row in k[starts]]
+    if len(keys) == 1:
+        names = [n[0] for n in names]
+    return {n: tuple(l.tolist()) for n,l in zip(names,labels)}
+
 @st.cache_data(show_spinner=False)
-def build_dropdowns(df):
-    makes = sorted(df["Make"].unique())
-    models = {mk: sorted(df[df["Make"]==mk]["Model"].unique()) for mk in makes}
-    series = {
-        (mk,mo): sorted(df[(df["Make"]==mk)&(df["Model"]==mo)]["Series"].unique())
-        for mk in makes for mo in models[mk]
-    }
-    engines = {
-        (mk,mo,ser): sorted(
-            df[(df["Make"]==mk)&(df["Model"]==mo)&(df["Series"]==ser)]["Engine Code"].unique()
-        )
-        for (mk,mo), sels in series.items() for ser in sels
-    }
-    roofs = {
-        (mk,mo,ser): sorted(
-            df[(df["Make"]==mk)&(df["Model"]==mo)&(df["Series"]==ser)]["Roof"].unique()
-        )
-        for (mk,mo), sels in series.items() for ser in sels
-    }
-    interiors = {
-        (mk,mo,ser): sorted(
-            df[(df["Make"]==mk)&(df["Model"]==mo)&(df["Series"]==ser)]["Interior"].unique()
-        )
-        for (mk,mo), sels in series.items() for ser in sels
-    }
-    regions = sorted(df["Auction Region"].dropna().unique())
-    colors = sorted(df["Color"].dropna().unique())
+def build_dropdowns(data_version):
+    df = load_data(data_version)
+    keys = df.index.to_frame(index=False)
+    trim = [keys["Make"],keys["Model"],keys["Series"]]
+    makes = tuple(sorted(keys["Make"].unique()))
+    models = _options_by(trim[:1],keys["Model"])
+    series = _options_by(trim[:2],keys["Series"])
+    engines = _options_by(trim,df["Engine Code"])
+    roofs = _options_by(trim,df["Roof"])
+    interiors = _options_by(trim,df["Interior"])
+    regions = tuple(sorted(df["Auction Region"].dropna().unique()))
+    colors = tuple(sorted(df["Color"].dropna().unique()))
     return makes, models, series, engines, roofs, interiors, regions, colors
 
+# rows sold on/after cutoff, sliced once per day and shared (not copied)
+# between reruns; keeps the trim/date sort order of load_data
+@st.cache_resource(show_spinner=False,max_entries=2)
+def recent_sales(data_version, cutoff):
+    df = load_data(data_version)
+    return df[df["Sold Date"]>=cutoff]
+
+# Make/Model/Series of the recent rows as flat int16 code arrays (from the
+# sorted index) plus their label lookups; the trim filter scans these instead
+# of the frame. memo holds label -> code translations for codes_for
+@st.cache_resource(show_spinner=False,max_entries=2)
+def filter_codes(data_version, cutoff):
+    df = recent_sales(data_version,cutoff)
+    idx = df.index
+    codes = {n: np.asarray(c,dtype=np.int16) for n,c in zip(idx.names,idx.codes)}
+    cats = dict(zip(idx.names,idx.levels))
+    return codes, cats, {}
+
+def codes_for(cats, memo, make, model, series):
+    # memo lives in the filter_codes resource, so it persists across reruns
+    # and sessions; raises KeyError for labels not in the data
+    key = (make,model,series)
+    v = memo.get(key)
+    if v is None:
+        v = memo[key] = (cats["Make"].get_loc(make),cats["Model"].get_loc(model),cats["Series"].get_loc(series))
+    return v
+
+# recent sales of the chosen trim within +/-2 model years; cached so repeat
+# estimates reuse one slice for both the chart and the transactions table.
+# Bounded: the daily cutoff in the key would otherwise grow it forever
+@st.cache_data(show_spinner=False,max_entries=256)
+def get_subset(data_version, make, model, series, year, cutoff):
+    df = recent_sales(data_version,cutoff)
+    codes, cats, memo = filter_codes(data_version,cutoff)
+    try:
+        mc, mdc, sc = codes_for(cats,memo,make,model,series)
+    except KeyError:
+        return df.iloc[:0].reset_index()
+    # recent_sales already applied the cutoff; a trim's rows are contiguous in
+    # the sorted frame, so slice its run rather than gather
+    rows = np.flatnonzero((codes["Make"]==mc) & (codes["Model"]==mdc) & (codes["Series"]==sc))
+    recent = df.iloc[rows[0]:rows[-1]+1] if rows.size else df.iloc[:0]
+    return recent[recent["Year"].between(year-2,year+2)].reset_index()
+
 # --- VIN decode ---
+@st.cache_resource(show_spinner=False)
+def vin_session():
+    # sqlite-backed, so repeat lookups survive restarts and skip the NHTSA round
+    # trip; one shared session also keeps the TLS connection alive between VINs
+    session = requests_cache.CachedSession(".vin_cache",expire_after=86400*30)
+    session.headers.update({"Accept":"application/json"})
+    return session
+
+# in-memory layer over the sqlite cache; errors raise instead of returning {}
+# so a failed lookup isn't cached for the day
+@st.cache_data(ttl=86400,show_spinner=False)
+def _decode_vin(vin:str) -> dict:
+    r = vin_session().get(
+        f"https://vpic.nhtsa.dot.gov/api/vehicles/DecodeVinValues/{vin}?format=json",
+        timeout=5
+    ).json()["Results"][0]
+    return {
+        "Year": int(r.get("ModelYear") or 0),
+        "Make": r.get("Make","").upper(),
+        "Model": r.get("Model","").upper(),
+        "Series": r.get("Trim","").upper(),
+        "Disp": r.get("Engine Displacement (L)") or "",
+        "EngMod": r.get("Engine Model") or ""
+    }
+
 def decode_vin(vin:str) -> dict:
     try:
-        r = requests.get(
-            f"https://vpic.nhtsa.dot.gov/api/vehicles/DecodeVinValues/{vin}?format=json",
-            timeout=5
-        ).json()["Results"][0]
-        return {
-            "Year": int(r.get("ModelYear") or 0),
-            "Make": r.get("Make","").upper(),
-            "Model": r.get("Model","").upper(),
-            "Series": r.get("Trim","").upper(),
-            "Disp": r.get("Engine Displacement (L)") or "",
-            "EngMod": r.get("Engine Model") or ""
-        }
+        return _decode_vin(vin)
     except:
         return {}
 
 # --- Prediction helper ---
-@st.cache_data(show_spinner=False)
-def predict_value(_pipeline, feat:dict):
-    cols = [
-        "Year","Make","Model","Series","Engine Code","Grade","Mileage",
-        "Drivable","Auction Region","Color","Roof","Interior","sale_month","age"
-    ]
-    rec = pd.DataFrame([{k:feat[k] for k in cols}], columns=cols)
-    # cast categoricals to str (defensive)
-    for c in ["Make","Model","Series","Engine Code","Drivable","Auction Region","Color","Roof","Interior"]:
-        rec[c] = rec[c].astype(str)
-    lp = _pipeline.predict(rec)[0]
-    return float(np.exp(lp))
+# feature dtypes as the pipeline was fit: labels (sale_month included) are
+# strings for the one-hot encoder, the rest numeric
+_DTYPES = {
+    "Year":"int64","Make":"object","Model":"object","Series":"object",
+    "Engine Code":"object","Grade":"float64","Mileage":"int64",
+    "Drivable":"object","Auction Region":"object","Color":"object",
+    "Roof":"object","Interior":"object","sale_month":"object","age":"int64"
+}
+
+# lru_cache on the feature tuple, held in a cache_resource so it survives reruns
+@st.cache_resource(show_spinner=False)
+def predictor():
+    pipeline = load_model()
+    # prebuilt single-row frame; filling a copy skips dict -> DataFrame
+    # inference per call. Copied, not reused, since sessions share predict
+    template = pd.DataFrame({c:np.zeros(1,dtype=t) for c,t in _DTYPES.items()})
+
+    @lru_cache(maxsize=256)
+    def predict(values:tuple) -> float:
+        rec = template.copy()
+        for c,v in zip(_DTYPES,values):
+            rec.at[0,c] = v
+        lp = pipeline.predict(rec)[0]
+        # scalar: math.exp is a direct C call, no ufunc dispatch
+        return math.exp(float(lp))
+    return predict
+
+def _feature_values(feat:dict) -> tuple:
+    # cast labels to str (defensive)
+    return tuple(str(feat[c]) if t=="object" else feat[c] for c,t in _DTYPES.items())
+
+def predict_value(feat:dict) -> float:
+    return predictor()(_feature_values(feat))
+
+def predict_values_batch(feats_list:list) -> np.ndarray:
+    # many vehicles (e.g. a VIN list) in one (B, 14) frame and a single
+    # pipeline.predict, instead of one frame + predict call per row
+    arr = np.empty((len(feats_list),len(_DTYPES)),dtype=object)
+    for i,feat in enumerate(feats_list):
+        arr[i] = _feature_values(feat)
+    rec = pd.DataFrame(arr,columns=list(_DTYPES)).astype(_DTYPES)
+    return np.exp(load_model().predict(rec))
+
+# --- Price history chart ---
+# fixed Vega-Lite spec; only the data changes between reruns, so skip
+# building and validating it through Altair every time
+_HISTORY_SPEC = {
+    "mark": {"type":"line","point":True},
+    "encoding": {
+        "x": {"field":"Sold Date","type":"temporal"},
+        "y": {"field":"Sale Price","type":"quantitative"},
+    },
+    "width": 700,
+    "height": 300,
+}
 
 # --- Load once ---
-df = load_data()
-pipeline = load_model()
-_makes, _models, _series, _engines, _roofs, _ints, _regions, _colors = build_dropdowns(df)
+_data_version = os.path.getmtime(DATA_XLSX)
+_makes, _models, _series, _engines, _roofs, _ints, _regions, _colors = build_dropdowns(_data_version)
 
 # --- Sidebar inputs ---
 st.sidebar.header("Input Vehicle Specs")
@@ -118,7 +269,7 @@ if vin:
 
 # Year & manual selects
 year = decoded.get("Year") if use_vin else st.sidebar.number_input(
-    "Model Year",1980,pd.Timestamp.now().year,pd.Timestamp.now().year
+    "Model Year",1980,_TODAY.year,_TODAY.year
 )
 make = st.sidebar.selectbox(
     "Make", _makes,
@@ -135,29 +286,32 @@ series = st.sidebar.selectbox(
 
 # Engine fallback
 disp = decoded.get("Disp","")
-elist = _engines.get((make,model,series),[])
-suggest = []
+elist = _engines.get((make,model,series),())
+suggest = None
 if use_vin and disp:
-    suggest = difflib.get_close_matches(str(disp),elist,n=1)
+    suggest = process.extractOne(str(disp),elist,scorer=fuzz.WRatio,score_cutoff=60)
 elif use_vin and decoded.get("EngMod"):
-    suggest = difflib.get_close_matches(decoded["EngMod"],elist,n=1)
-if suggest:
-    st.sidebar.info(f"Using closest engine match: {suggest[0]}")
-    engine = suggest[0]
-else:
-    engine = st.sidebar.selectbox("Engine Type",elist)
-
-roof = st.sidebar.selectbox("Roof Type",_roofs.get((make,model,series),[]))
-interior = st.sidebar.selectbox("Interior Type",_ints.get((make,model,series),[]))
-grade = st.sidebar.slider("Grade",1.0,5.0,3.0)
-mileage = st.sidebar.number_input("Mileage",0,300000,50000)
-drivable = st.sidebar.selectbox("Drivable",["Yes","No"])
-region = st.sidebar.selectbox("Auction Region",_regions)
-color = st.sidebar.selectbox("Exterior Color",_colors)
+    suggest = process.extractOne(decoded["EngMod"],elist,scorer=fuzz.WRatio,score_cutoff=60)
+
+# non-cascading specs in a form: no rerun until the estimate is requested
+with st.sidebar.form("specs"):
+    if suggest:
+        st.info(f"Using closest engine match: {suggest[0]}")
+        engine = suggest[0]
+    else:
+        engine = st.selectbox("Engine Type",elist)
+    roof = st.selectbox("Roof Type",_roofs.get((make,model,series),()))
+    interior = st.selectbox("Interior Type",_ints.get((make,model,series),()))
+    grade = st.slider("Grade",1.0,5.0,3.0)
+    mileage = st.number_input("Mileage",0,300000,50000)
+    drivable = st.selectbox("Drivable",["Yes","No"])
+    region = st.selectbox("Auction Region",_regions)
+    color = st.selectbox("Exterior Color",_colors)
+    submitted = st.form_submit_button("Estimate Wholesale Value")
 
 # derive
-sale_month = pd.Timestamp.now().month
-age = pd.Timestamp.now().year - year
+sale_month = _TODAY.month
+age = _TODAY.year - year
 
 # --- Main title ---
 st.title("🚗 Carolina Auto Auction Wholesale Evaluator")
@@ -170,37 +324,26 @@ def do_estimate():
         "Drivable":drivable,"Auction Region":region,"Color":color,
         "Roof":roof,"Interior":interior,"sale_month":sale_month,"age":age
     }
-    val = predict_value(pipeline,feats)
+    val = predict_value(feats)
     st.success(f"💰 Estimated Wholesale Value: ${val:,.2f}")
     st.session_state["made_estimate"] = True
 
-if st.sidebar.button("Estimate Wholesale Value"):
+if submitted:
     do_estimate()
 
 # After estimate: history & table
 if st.session_state["made_estimate"]:
-    cutoff = pd.Timestamp.now() - pd.Timedelta(days=120)
-    low,high = year-2,year+2
-    subset = df[
-        (df["Sold Date"]>=cutoff) &
-        (df["Year"].between(low,high)) &
-        (df["Make"]==make) &
-        (df["Model"]==model) &
-        (df["Series"]==series)
-    ]
+    subset = get_subset(_data_version,make,model,series,year,_CUTOFF_120)
     st.subheader("Price History & Recent Sales")
     if not subset.empty:
-        chart = (
-            alt.Chart(subset).mark_line(point=True)
-               .encode(x="Sold Date:T",y="Sale Price:Q")
-               .properties(width=700,height=300)
-        )
-        st.altair_chart(chart,use_container_width=True)
+        st.vega_lite_chart(subset[["Sold Date","Sale Price"]],_HISTORY_SPEC,use_container_width=True)
         st.subheader("Last 10 Transactions")
-        last10 = subset.sort_values("Sold Date",ascending=False).head(10)
+        # subset is already date-ascending: newest ten are its tail, no sort needed
+        last10 = subset.iloc[::-1].head(10)
         st.dataframe(
             last10[["Sold Date","Year","Make","Model","Series","Engine Code","Drivable","Roof","Interior","Grade","Mileage","Sale Price"]],
             hide_index=True,use_container_width=True
         )
     else:
         st.info("No recent transactions found.")
+